@@ -1,4 +1,17 @@
 import re
+import string
+
+try:
+    from sys import intern
+except ImportError:
+    pass # Python 2 has `intern` as a builtin
+
+_WORD_START = frozenset(string.ascii_letters + string.digits)
+_WORD_CHARS = frozenset(string.ascii_letters + string.digits + '-')
+_LINE_CHARS = frozenset('\r\n \t')
+_WS_CHARS = frozenset(' \t')
+
+_RE_DESC = re.compile(r'>[ \t]*(.*)[\r\n]')
 
 class Parser(object):
 
@@ -7,43 +20,85 @@ class Parser(object):
         self.pos = 0
 
     def lex_lit(self, lit):
-        if self.pos + len(lit) > len(self.text):
-            return None
-        if self.text[self.pos:self.pos + len(lit)] == lit:
+        if self.text.startswith(lit, self.pos):
             self.pos += len(lit)
             return lit
         return None
 
     def lex_regex(self, pat):
-        mat = re.match(pat, self.text[self.pos:])
+        """Matches a pattern string or a compiled pattern at the current
+        position. The text is not sliced, so `^` only matches at the start of
+        the whole text (or of a line with re.M) and lookbehinds can see text
+        before the current position.
+        """
+
+        if not hasattr(pat, 'match'):
+            pat = re.compile(pat)
+        return self.lex_pat(pat)
+
+    def lex_pat(self, pat):
+        mat = pat.match(self.text, self.pos)
         if mat:
-            self.pos += len(mat.group(0))
-            return mat
-        else:
-            return None
+            self.pos = mat.end()
+        return mat
 
     def lex_re(self, pat):
         mat = self.lex_regex(pat)
         return mat.group(0) if mat else None
 
+    def lex_chars(self, chars):
+        t, p, n = self.text, self.pos, len(self.text)
+        q = p
+        while q < n and t[q] in chars:
+            q += 1
+        if q == p:
+            return None
+        self.pos = q
+        return t[p:q]
+
 class DbParser(Parser):
     def __init__(self, text):
         self.text = text
         self.pos = 0
 
+    def lex_ident(self, min_len):
+        """Lexes `[A-Za-z0-9][A-Za-z0-9\\-]*!?` with at least `min_len`
+        characters before the optional '!'
+        """
+
+        t, p, n = self.text, self.pos, len(self.text)
+        if p >= n or t[p] not in _WORD_START:
+            return None
+        q = p + 1
+        while q < n and t[q] in _WORD_CHARS:
+            q += 1
+        if q - p < min_len:
+            return None
+        if q < n and t[q] == '!':
+            q += 1
+        self.pos = q
+        return t[p:q]
+
     def lex_word(self):
-        return self.lex_re(r'[A-Za-z0-9][A-Za-z0-9\-]*!?')
+        return self.lex_ident(1)
 
     def lex_line(self):
         self.lex_ws()
-        return self.lex_re(r'[\r\n \t]+')
+        return self.lex_chars(_LINE_CHARS)
 
     def lex_ws(self):
-        return self.lex_re(r'[ \t]+')
+        return self.lex_chars(_WS_CHARS)
+
+    def lex_sign(self):
+        if self.pos < len(self.text) and self.text[self.pos] in '-+':
+            self.pos += 1
+            return self.text[self.pos - 1]
+        return None
 
     def parse_binds(s):
+        binds = []
         if not s.lex_lit('('):
-            return
+            return binds
 
         first = True
         s.lex_ws()
@@ -54,34 +109,40 @@ class DbParser(Parser):
                 s.lex_ws()
             bind = s.lex_word()
             assert bind, "Expected bind"
-            yield bind
+            binds.append(bind)
             s.lex_ws()
             first = False
 
+        return binds
+
     def parse_tag(s):
-        sign = s.lex_re(r'[-+]')
+        sign = s.lex_sign()
         assert sign, "Expected sign"
         
-        tag = s.lex_re(r'[A-Za-z0-9][A-Za-z0-9\-]+!?')
+        tag = s.lex_ident(2)
         assert tag, "Expected tag name"
 
+        # Tag names are compared a lot so intern them for identity checks
+        tag = intern(tag)
+
         binds = tuple(s.parse_binds())
             
         return (sign == '+', tag, binds)
 
     def parse_patterns(s):
+        patterns = []
         while True:
             s.lex_ws()
             entity = s.lex_word()
             if not entity:
-                return
+                return patterns
 
             while not s.lex_line():
                 s.lex_ws()
                 tag = s.parse_tag()
                 assert tag, "Expected tag"
 
-                yield (entity, tag)
+                patterns.append((entity, tag))
 
     def parse_rule(s):
         s.lex_line()
@@ -94,7 +155,7 @@ class DbParser(Parser):
 
         s.lex_line()
 
-        ma_desc = s.lex_regex(r'>[ \t]*(.*)[\r\n]')
+        ma_desc = s.lex_pat(_RE_DESC)
         assert ma_desc, "Expected rule description"
         desc = ma_desc.group(1)
 
@@ -112,8 +173,10 @@ class DbParser(Parser):
         return (name, desc, pre, post)
 
     def parse_rules(s):
+        rules = []
         while s.pos < len(s.text):
-            yield s.parse_rule()
+            rules.append(s.parse_rule())
+        return rules
 
     def parse_entities(s):
         s.lex_line()
@@ -129,7 +192,7 @@ class DbParser(Parser):
 
 def parse_rules(s):
     p = DbParser(s)
-    return list(p.parse_rules())
+    return p.parse_rules()
 
 def parse_entities(s):
     p = DbParser(s)
@@ -1,23 +1,82 @@
-from collections import namedtuple, defaultdict, OrderedDict, Counter
+from collections import namedtuple, defaultdict, OrderedDict, deque
 import itertools
+import operator
 
 import db_parse
 
-Entity = namedtuple('Entity', 'id name tags notags')
+_EntityTuple = namedtuple('Entity', 'id name tags notags tagset notagset distinct_tag_names')
+
+class Entity(_EntityTuple):
+    """Entity created from `id name tags notags`, the rest of the fields are
+    derived from them: `tagset` and `notagset` are frozensets of `tags` and
+    `notags` for fast lookups and `distinct_tag_names` contains the names of
+    both"""
+
+    __slots__ = ()
+    _base_fields = ('id', 'name', 'tags', 'notags')
+
+    def __new__(cls, id, name, tags, notags):
+        tags, notags = tuple(tags), tuple(notags)
+        names = frozenset(t.tag for t in itertools.chain(tags, notags))
+        return _EntityTuple.__new__(cls, id, name, tags, notags,
+                frozenset(tags), frozenset(notags), names)
+
+    @classmethod
+    def _make(cls, iterable):
+        return cls(*tuple(iterable)[:len(cls._base_fields)])
+
+    def _replace(self, **kwds):
+        fields = dict(zip(self._base_fields, self))
+        fields.update(kwds)
+        return type(self)(**fields)
+
+    def __getnewargs__(self):
+        return tuple(self[:len(self._base_fields)])
+
 Tag = namedtuple('Tag', 'tag binds')
 Pattern = namedtuple('Pattern', 'sign entity tag')
 
+def update_entity(entity, tags, notags):
+    """Returns `entity` with new tags, reusing it as-is if they are the same"""
+
+    if entity.tagset == tags and (entity.notagset == notags if notags else not entity.notags):
+        return entity
+    return Entity(entity.id, entity.name, tags, notags)
+
+def has_tag(entity, tname, binds):
+    """Returns whether an entity has a tag named `tname` bound to entity ids
+    `binds`"""
+
+    if Tag(tname, binds) in entity.tagset:
+        return True
+
+    # Tags with a different amount of binds match on the common ones,
+    # for example `-hold` matches `hold(object)`, equal amounts were
+    # already handled by the lookup above
+    num = len(binds)
+    for t in entity.tags:
+        if t.tag is not tname and t.tag != tname:
+            continue
+        tnum = len(t.binds)
+        if tnum != num and t.binds[:num] == binds[:tnum]:
+            return True
+    return False
+
 def tag_match(entity, tag, entities):
     """Returns whether a matching tag is found in a entity, the list of
     entities is required for tags with binds such as `+hold(object)`
     """
 
-    for t in entity.tags:
-        if t.tag != tag.tag:
-            continue
-        if any(entities[bp].id != bt for bt, bp in zip(t.binds, tag.binds)):
-            continue
-        return True
+    return has_tag(entity, tag.tag, tuple(entities[bp].id for bp in tag.binds))
+
+def has_duplicate_tags(tags):
+    """Returns whether there are multiple tags with the same name"""
+
+    seen = set()
+    for t in tags:
+        if t.tag in seen:
+            return True
+        seen.add(t.tag)
     return False
 
 def pattern_match(pat, entities):
@@ -46,9 +105,34 @@ def unswizzle_tuple(original, lst, indices):
     else:
         return tuple(lst)
 
+_MISS = object()
+
+class LruCache(object):
+    """Dictionary of bounded size that evicts the least recently used items"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        """Returns the value for a key or `_MISS` if not found"""
+
+        value = self.items.pop(key, _MISS)
+        if value is not _MISS:
+            self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
 class Rule(object):
 
-    def __init__(self, name, desc, names, pre, post):
+    # Generate specialized code for `forward` and `backward` of each rule
+    specialize = True
+
+    def __init__(self, name, desc, names, pre, post, tag_producers=None):
         self.name = name
         self.desc = desc
         self.names = names
@@ -56,6 +140,115 @@ class Rule(object):
         self.pre = pre
         self.post = post
         self.action = '!' in name
+        self._pre_flat = tuple((p.sign, p.entity, p.tag.tag, p.tag.binds) for p in pre)
+        self._post_flat = tuple((p.sign, p.entity, p.tag.tag, p.tag.binds) for p in post)
+        self.produces = tuple(frozenset((p.sign, p.tag.tag) for p in post if p.entity == i)
+                for i in range(self.num))
+        self._swizzlers = { }
+        self._formatted = self._format_rule()
+        self.order_pre(tag_producers)
+
+    def order_pre(self, tag_producers=None):
+        """Orders the precondition checks of `forward` so that the ones least
+        likely to match are tried first
+
+        tag_producers: Optional dict of how many rules produce each tag name
+        """
+
+        producers = tag_producers or { }
+        def selectivity(p):
+            return (len(p.tag.binds), -producers.get(p.tag.tag, 0), not p.sign)
+        self._pre_checks = tuple(sorted(self.pre, key=selectivity, reverse=True))
+        self._specialize()
+
+    def _specialize(self):
+        """Generates `_forward_impl` and `_backward_impl` with the patterns
+        of the rule unrolled. They fall back to the generic `_forward_slow` and
+        `_backward_slow` if there are extra entities without a swizzle.
+        """
+
+        if not self.specialize or self.num == 0:
+            self._forward_impl = self._forward_slow
+            self._backward_impl = self._backward_slow
+            return
+
+        env = {
+            '_Tag': Tag, '_has': has_tag, '_dup': has_duplicate_tags,
+            '_update': update_entity, '_unswizzle': unswizzle_tuple,
+            '_swizzle': self._swizzle_entities,
+            '_forward_slow': self._forward_slow,
+            '_backward_slow': self._backward_slow,
+        }
+
+        # Tag names are passed as globals to keep them interned
+        def name(tname):
+            const = '_n{}'.format(len(env))
+            env[const] = tname
+            return const
+
+        def binds(tbinds):
+            return '({})'.format(''.join('e{}.id, '.format(b) for b in tbinds))
+
+        def tag(tname, tbinds):
+            return '_Tag({}, {})'.format(name(tname), binds(tbinds))
+
+        slots = range(self.num)
+        unpack = ''.join('e{}, '.format(i) for i in slots)
+        head = lambda fn: [
+            'def {}(entity_list, swizzle):'.format(fn),
+            '    entities = _swizzle(entity_list, swizzle)',
+            '    if len(entities) != {}:'.format(self.num),
+            '        return _{}_slow(entity_list, swizzle)'.format(fn),
+            '    {}= entities'.format(unpack),
+        ]
+
+        src = head('forward')
+        for p in self._pre_checks:
+            src.append('    if {}_has(e{}, {}, {}): return None'.format(
+                'not ' if p.sign else '', p.entity, name(p.tag.tag), binds(p.tag.binds)))
+        for i in slots:
+            src.append("    t{0} = set(t for t in e{0}.tags if '!' not in t.tag)".format(i))
+        for sign, ent, tname, tbinds in self._post_flat:
+            if sign:
+                src.append('    t{}.add({})'.format(ent, tag(tname, tbinds)))
+            else:
+                src.append('    t{0}.difference_update([t for t in t{0} if t.tag == {1}])'.format(
+                    ent, name(tname)))
+        src.append('    return _unswizzle(entity_list, ({}), swizzle)'.format(
+            ''.join('_update(e{0}, t{0}, ()), '.format(i) for i in slots)))
+
+        src += head('backward')
+        for i in slots:
+            src.append('    t{0}, n{0} = set(e{0}.tagset), set(e{0}.notags)'.format(i))
+        for sign, ent, tname, tbinds in self._post_flat:
+            src.append('    {}{}.discard({})'.format('tn'[not sign], ent, tag(tname, tbinds)))
+        for sign, ent, tname, tbinds in self._pre_flat:
+            src.append('    {}{}.add({})'.format('tn'[not sign], ent, tag(tname, tbinds)))
+        src.append('    if {}: return None'.format(' or '.join('_dup(t{})'.format(i) for i in slots)))
+        src.append('    return _unswizzle(entity_list, ({}), swizzle)'.format(
+            ''.join('_update(e{0}, t{0}, n{0}), '.format(i) for i in slots)))
+
+        code = compile('\n'.join(src) + '\n', '<rule {}>'.format(self.name), 'exec')
+        exec(code, env)
+        self._forward_impl = env['forward']
+        self._backward_impl = env['backward']
+
+    def _swizzle_entities(self, entity_list, swizzle):
+        """Same as `swizzle_tuple` but caches an item getter per swizzle"""
+
+        if not swizzle:
+            return tuple(entity_list)
+        try:
+            getter = self._swizzlers.get(swizzle)
+        except TypeError:
+            return swizzle_tuple(entity_list, swizzle)
+        if getter is None:
+            if len(swizzle) == 1:
+                getter = lambda lst, i=swizzle[0]: (lst[i],)
+            else:
+                getter = operator.itemgetter(*swizzle)
+            self._swizzlers[swizzle] = getter
+        return getter(entity_list)
 
     def forward(self, entity_list, swizzle=None):
         """Applies the rule forwards to entities, which is what the simulation
@@ -66,25 +259,30 @@ class Rule(object):
         swizzle: Optional list of indices for which entities to apply the rule for
         """
 
+        return self._forward_impl(entity_list, swizzle)
+
+    def _forward_slow(self, entity_list, swizzle):
         if len(swizzle) < self.num if swizzle else len(entity_list) < self.num:
             raise IndexError("Not enough entities provided for rule '{}'".format(self.name))
 
-        entities = swizzle_tuple(entity_list, swizzle)
+        entities = self._swizzle_entities(entity_list, swizzle)
+        _Tag = Tag
 
         tags = [set(t for t in e.tags if '!' not in t.tag) for e in entities]
 
-        if not all(pattern_match(p, entities) for p in self.pre):
-            return None
+        for p in self._pre_checks:
+            if tag_match(entities[p.entity], p.tag, entities) != p.sign:
+                return None
 
-        for pat in self.post:
-            binds = tuple(entities[b].id for b in pat.tag.binds)
-            if pat.sign:
-                tags[pat.entity].add(Tag(pat.tag.tag, binds))
+        for sign, ent, tname, tbinds in self._post_flat:
+            if sign:
+                binds = tuple(entities[b].id for b in tbinds)
+                tags[ent].add(_Tag(tname, binds))
             else:
-                rem = set(t for t in tags[pat.entity] if t.tag == pat.tag.tag)
-                tags[pat.entity] -= rem
+                rem = set(t for t in tags[ent] if t.tag == tname)
+                tags[ent] -= rem
 
-        new_entities = tuple(Entity(e.id, e.name, tuple(t), ()) for e,t in zip(entities, tags))
+        new_entities = tuple(update_entity(e, t, ()) for e,t in zip(entities, tags))
         asd = unswizzle_tuple(entity_list, new_entities, swizzle)
         return asd
 
@@ -97,37 +295,39 @@ class Rule(object):
         swizzle: Optional list of indices for which entities to apply the rule for
         """
 
+        return self._backward_impl(entity_list, swizzle)
+
+    def _backward_slow(self, entity_list, swizzle):
         if len(swizzle) < self.num if swizzle else len(entity_list) < self.num:
             raise IndexError("Not enough entities provided for rule '{}'".format(self.name))
 
-        entities = swizzle_tuple(entity_list, swizzle)
+        entities = self._swizzle_entities(entity_list, swizzle)
+        _Tag = Tag
 
-        tags = [set(e.tags) for e in entities]
+        tags = [set(e.tagset) for e in entities]
         notags = [set(e.notags) for e in entities]
 
         # Remove provided postconditions
-        for pat in self.post:
-            binds = tuple(entities[b].id for b in pat.tag.binds)
-            if pat.sign:
-                tags[pat.entity].discard(Tag(pat.tag.tag, binds))
+        for sign, ent, tname, tbinds in self._post_flat:
+            binds = tuple(entities[b].id for b in tbinds)
+            if sign:
+                tags[ent].discard(_Tag(tname, binds))
             else:
-                notags[pat.entity].discard(Tag(pat.tag.tag, binds))
+                notags[ent].discard(_Tag(tname, binds))
 
         # Add required precondition tags
-        for pat in self.pre:
-            binds = tuple(entities[b].id for b in pat.tag.binds)
-            if pat.sign:
-                tags[pat.entity].add(Tag(pat.tag.tag, binds))
+        for sign, ent, tname, tbinds in self._pre_flat:
+            binds = tuple(entities[b].id for b in tbinds)
+            if sign:
+                tags[ent].add(_Tag(tname, binds))
             else:
-                notags[pat.entity].add(Tag(pat.tag.tag, binds))
+                notags[ent].add(_Tag(tname, binds))
 
         # If there are multiples of some tag then this production is invalid
-        for ts in tags:
-            tagcount = Counter(t.tag for t in ts)
-            if ts and tagcount.most_common(1)[0][1] > 1:
-                return None
+        if any(has_duplicate_tags(ts) for ts in tags):
+            return None
 
-        new_entities = tuple(Entity(e.id, e.name, tuple(t), tuple(nt)) for e,t,nt in zip(entities, tags, notags))
+        new_entities = tuple(update_entity(e, t, nt) for e,t,nt in zip(entities, tags, notags))
         return unswizzle_tuple(entity_list, new_entities, swizzle)
 
     def format_desc(self, entity_list, swizzle=None):
@@ -138,11 +338,11 @@ class Rule(object):
         return self.desc.format(**namemap)
 
     def format_rule(self):
-        """Pretty prints the rule using the format of `parse_rules`
-        
-        swizzle: Optional list of indices for which entities to apply the rule for
-        """
+        """Pretty prints the rule using the format of `parse_rules`"""
+
+        return self._formatted
 
+    def _format_rule(self):
         def fmt_tag(sign, tag):
             if tag.binds:
                 binds = ','.join(self.names[b] for b in tag.binds)
@@ -174,6 +374,14 @@ def parse_rules(s):
         other +hurt!
     """
 
+    parsed = db_parse.parse_rules(s)
+
+    # How many rules produce each tag, used to order precondition checks
+    tag_producers = defaultdict(int)
+    for name, desc, pre, post in parsed:
+        for tag in set(p[1][1] for p in post if p[1][0]):
+            tag_producers[tag] += 1
+
     def create_rule(name, desc, pre, post):
         names = list(OrderedDict.fromkeys(p[0] for p in pre + post))
 
@@ -183,9 +391,9 @@ def parse_rules(s):
             return Pattern(sign, names.index(entity), tg)
 
         pre, post = ([create_pattern(p) for p in pats] for pats in (pre, post))
-        return Rule(name, desc, names, pre, post)
+        return Rule(name, desc, names, pre, post, tag_producers)
 
-    return [create_rule(*r) for r in db_parse.parse_rules(s)]
+    return [create_rule(*r) for r in parsed]
 
 def parse_entities(s):
     """Parse entities from a string, for example:
@@ -223,6 +431,7 @@ def format_entities(entities):
 
 AiRule = namedtuple('AiRule', 'rule swizzle')
 AiChain = namedtuple('AiChain', 'start rules')
+AiNode = namedtuple('AiNode', 'score entities chain forward_states')
 
 def format_ai_rule(ai_rule):
     """Pretty prints AI rule in form of 'rule-name(0,1,2)'"""
@@ -244,17 +453,73 @@ def ai_search(rules, root_rule, num_entities, max_depth):
     attempt to return the most relevant and plausible ones first.
     """
 
-    return ai_search_dumb(rules, root_rule, num_entities, max_depth)
+    return ai_search_greedy(rules, root_rule, num_entities, max_depth)
+
+def step_forward(entities, ai_rule):
+    """Applies an AI rule forwards, returns None if it's not applicable"""
+
+    return ai_rule.rule.forward(entities, swizzle=ai_rule.swizzle)
+
+def same_state(entities_a, entities_b):
+    """Returns whether rules applied forwards to the entities would behave
+    the same. Only `tagset` is compared: entities are in the same positions
+    (so `id` and `name` match) and this assumes `Rule.forward` reads only
+    `id` and the tags of entities, not `notags`. If `forward` ever depends on
+    `notags` this must compare them too or `forward_chain` will reuse states
+    incorrectly.
+    """
+
+    return all(a is b or a.tagset == b.tagset for a, b in zip(entities_a, entities_b))
+
+def forward_chain(entities, chain, known_states=None):
+    """Simulates a chain of AI rules forwards starting from entities.
+    Returns a list of the states before each rule and after the last one or
+    None if the chain can't be applied.
+
+    known_states: Optional result of `forward_chain` for `chain[1:]`, once
+    the simulation reaches one of these states the rest is reused
+    """
+
+    states = [entities]
+    for i, ai_rule in enumerate(chain):
+        entities = step_forward(entities, ai_rule)
+        if not entities:
+            return None
+        if known_states and same_state(entities, known_states[i]):
+            return states + list(known_states[i:])
+        states.append(entities)
+    return states
+
+def check_chain(entities, chain):
+    """Returns whether a chain of AI rules can be applied in order starting
+    from entities"""
 
-def ai_search_dumb(rules, root_rule, num_entities, max_depth):
+    return forward_chain(entities, chain) is not None
+
+def ai_search_dumb(rules, root_rule, num_entities, max_depth, cache_size=4096):
     """See ai_search for the interface.
 
     Probably the dumbest and most straightforward implementation of this
     function. Just try all combinations of increasing length.
+
+    cache_size: Number of rule applications to remember, the same rules end
+    up being applied to the same entities a lot from different chains. Zero
+    disables the cache.
     """
 
     indices = list(range(num_entities))
 
+    cache = LruCache(cache_size)
+    def apply(forward, rule, entities, swizzle):
+        if not cache_size:
+            return (rule.forward if forward else rule.backward)(entities, swizzle)
+        key = (forward, rule, tuple(swizzle), tuple(entities))
+        result = cache.get(key)
+        if result is _MISS:
+            result = (rule.forward if forward else rule.backward)(entities, swizzle)
+            cache.put(key, result)
+        return result
+
     def dumb_step(entities, chain, depth):
 
         # Yield current result (also the first)
@@ -278,7 +543,7 @@ def ai_search_dumb(rules, root_rule, num_entities, max_depth):
                     continue
 
                 # Try to simulate the rule backwards
-                enext = rule.backward(entities, swizzle=permutation)
+                enext = apply(False, rule, entities, permutation)
                 if not enext:
                     continue
 
@@ -287,7 +552,7 @@ def ai_search_dumb(rules, root_rule, num_entities, max_depth):
                 # Check that the chain can be actually applied
                 es = enext
                 for r, s in cnext:
-                    es = r.forward(es, swizzle=s)
+                    es = apply(True, r, es, s)
                     if not es:
                         break
                 else:
@@ -304,3 +569,111 @@ def ai_search_dumb(rules, root_rule, num_entities, max_depth):
     for chain in dumb_step(start_entities, [AiRule(root_rule, indices[:root_rule.num])], 0):
         yield chain
 
+def ai_search_greedy(rules, root_rule, num_entities, max_depth, visited_size=65536):
+    """See ai_search for the interface.
+
+    Searches backwards from the root rule only trying rules that produce
+    some tag that the current start entities require, shortest chains first.
+    Chains leading to an already found start state are skipped.
+
+    visited_size: Maximum number of start states to remember
+    """
+
+    indices = list(range(num_entities))
+
+    # Tags are keyed by `(sign, tag)` so that eg. `-hold` in a postcondition
+    # produces the `-hold` a later precondition requires
+    tag_producers = defaultdict(set)
+    for rule in rules:
+        if num_entities < rule.num:
+            continue
+        for key in frozenset().union(*rule.produces):
+            tag_producers[key].add(rule)
+
+    tag_bits = { }
+    def tag_mask(keys):
+        mask = 0
+        for key in keys:
+            mask |= tag_bits.setdefault(key, 1 << len(tag_bits))
+        return mask
+
+    # For each entity slot of a rule the mask of tags it produces
+    slot_masks = { rule: tuple(tag_mask(ks) for ks in rule.produces) for rule in rules }
+
+    # Entity permutations per rule size, action rules require the actor to be
+    # the first entity
+    perms_all = { n: list(itertools.permutations(indices, n)) for n in set(r.num for r in rules) }
+    perms_action = { n: [p for p in ps if p and p[0] == 0] for n, ps in perms_all.items() }
+
+    def required_keys(entity):
+        return itertools.chain(
+            ((True, t.tag) for t in entity.tags),
+            ((False, t.tag) for t in entity.notags))
+
+    # Scores are chain depths so use a bucket per depth instead of a heap,
+    # children always score higher than their parent so `min_bucket` only
+    # needs to advance
+    buckets = [deque() for _ in range(max(max_depth, 0) + 1)]
+    def push(node):
+        buckets[node.score].append(node)
+
+    # States that have already been queued, as nodes are expanded in order of
+    # depth the first chain to reach a state is always the shortest one
+    visited = LruCache(visited_size)
+    def state_key(entities):
+        return tuple((e.tagset, e.notagset) for e in entities)
+
+    start_entities = [Entity(i, 'e_{}'.format(i), (), ()) for i in range(num_entities)]
+
+    # Always apply the root rule
+    start_entities = root_rule.backward(start_entities)
+    visited.put(state_key(start_entities), True)
+    root_chain = [AiRule(root_rule, indices[:root_rule.num])]
+    push(AiNode(0, start_entities, root_chain, forward_chain(start_entities, root_chain)))
+
+    min_bucket = 0
+    while True:
+        while min_bucket < len(buckets) and not buckets[min_bucket]:
+            min_bucket += 1
+        if min_bucket >= len(buckets):
+            break
+        node = buckets[min_bucket].popleft()
+        yield AiChain(node.entities, node.chain)
+
+        # Reached the end
+        if node.score >= max_depth:
+            continue
+
+        required = [frozenset(required_keys(e)) for e in node.entities]
+        required_masks = [tag_mask(ks) for ks in required]
+        candidates = set()
+        for key in frozenset().union(*required):
+            candidates.update(tag_producers[key])
+
+        for rule in rules:
+            if rule not in candidates:
+                continue
+            masks = slot_masks[rule]
+            perms = perms_action[rule.num] if rule.action else perms_all[rule.num]
+
+            for permutation in perms:
+
+                # Some entity must receive a tag it requires from the rule
+                if not any(m & required_masks[i] for m, i in zip(masks, permutation)):
+                    continue
+
+                enext = rule.backward(node.entities, swizzle=permutation)
+                if not enext:
+                    continue
+
+                key = state_key(enext)
+                if visited.get(key) is not _MISS:
+                    continue
+
+                # Check that the chain can be actually applied, only the new
+                # rule needs to be simulated until it joins the known states
+                cnext = [AiRule(rule, permutation)] + node.chain
+                states = forward_chain(enext, cnext, node.forward_states)
+                if states:
+                    visited.put(key, True)
+                    push(AiNode(node.score + 1, enext, cnext, states))
@@ -0,0 +1,75 @@
+import db_proto as db
+import itertools
+import random
+
+from db_proto_rules import weaponhit
+
+# Differential checks for the optimized code paths of db_proto, raises an
+# AssertionError if they disagree with the straightforward versions
+
+rules = db.parse_rules(weaponhit)
+tag_names = sorted(set(p.tag.tag for r in rules for p in r.pre + r.post))
+
+def random_entities(rng, num):
+    def random_tags():
+        return set(db.Tag(rng.choice(tag_names),
+                tuple(rng.randrange(num) for _ in range(rng.randint(0, 1))))
+            for _ in range(rng.randint(0, 4)))
+
+    return [db.Entity(i, 'e_{}'.format(i), random_tags(),
+            random_tags() if rng.random() < 0.5 else ()) for i in range(num)]
+
+def call(impl, entities, swizzle):
+    try:
+        return impl(entities, swizzle)
+    except IndexError:
+        return IndexError
+
+def check_specialized(iterations=2000, seed=1):
+    """Generated `_forward_impl`/`_backward_impl` agree with the generic
+    `_forward_slow`/`_backward_slow`"""
+
+    rng = random.Random(seed)
+    for _ in range(iterations):
+        num = rng.randint(1, 4)
+        entities = random_entities(rng, num)
+        for rule in rules:
+            swizzles = [None] + list(itertools.permutations(range(num), rule.num))
+            for swizzle in swizzles:
+                for fast, slow in ((rule._forward_impl, rule._forward_slow),
+                        (rule._backward_impl, rule._backward_slow)):
+                    expected = call(slow, entities, swizzle)
+                    assert call(fast, entities, swizzle) == expected, (rule.name, swizzle)
+
+def check_forward_chain(num_entities=5, max_depth=8):
+    """`forward_chain` reusing the states of a parent chain in
+    `ai_search_greedy` agrees with simulating the whole chain"""
+
+    def state(entities):
+        return tuple((e.id, e.tagset) for e in entities)
+
+    forward_chain = db.forward_chain
+    checked = [0]
+    def checked_forward_chain(entities, chain, known_states=None):
+        states = forward_chain(entities, chain, known_states)
+        if known_states is not None:
+            expected = forward_chain(entities, chain)
+            assert (states is None) == (expected is None), chain
+            if states is not None:
+                assert [state(s) for s in states] == [state(s) for s in expected], chain
+            checked[0] += 1
+        return states
+
+    db.forward_chain = checked_forward_chain
+    try:
+        for chain in db.ai_search_greedy(rules, rules[0], num_entities, max_depth):
+            pass
+    finally:
+        db.forward_chain = forward_chain
+    assert checked[0] > 0
+
+check_specialized()
+print('specialized rules ok')
+
+check_forward_chain()
+print('incremental forward_chain ok')
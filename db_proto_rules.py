@@ -0,0 +1,39 @@
+# Example rules shared by db_proto_test.py and db_proto_check.py
+
+weaponhit = r'''
+
+# weapon-hit!
+> {dwarf} hits {thing} with {weapon}
+    dwarf +dwarf +hold(weapon)
+    weapon +weapon
+    ->
+    thing +hurt!
+
+# pick-up!
+> {dwarf} picks up {thing}
+    dwarf +dwarf -hold
+    thing +holdable
+    ->
+    dwarf +hold(thing)
+
+# drop!
+> {dwarf} drops {thing}
+    dwarf +dwarf +hold(thing)
+    thing +holdable
+    ->
+    dwarf -hold
+    thing +fall!
+
+# fall-break
+> {object} breaks as it falls
+    object +fall!
+    ->
+    object +break!
+
+# glass-break
+> {glass} breaks into shards
+    glass +glass +break!
+    ->
+    glass +weapon
+
+'''